@@ -7,24 +7,46 @@ version."""
 
 import os
 import json
+import atexit
+import threading
+from contextlib import contextmanager
+from collections.abc import Hashable
 
 from . import util
 from .coreconf import *
 
 APPLICATION = _('Farragone')
 
-for d in (PATH_CONF_WRITE,):
-    try:
-        os.makedirs(d, exist_ok = True)
-    except OSError as e:
-        util.warn(_('failed creating directory: {}:').format(repr(d)), e)
+
+def _create_dirs ():
+    # create directories we write to
+    for d in (PATH_CONF_WRITE,):
+        try:
+            os.makedirs(d, exist_ok = True)
+        except OSError as e:
+            util.warn(_('failed creating directory: {}:').format(repr(d)), e)
+
+
+# placeholder for a missing setting value
+_UNSET = object()
+
+
+def _identity (x):
+    return x
+
+
+# conversions to JSON-compatible values for types used in settings
+_JSON_CONVERSIONS = {set: list, frozenset: list}
 
 
 class _JSONEncoder (json.JSONEncoder):
     """Extended json.JSONEncoder with support for any iterable."""
 
     def default (self, o):
-        if hasattr(o, '__iter__'):
+        convert = _JSON_CONVERSIONS.get(type(o))
+        if convert is not None:
+            return convert(o)
+        elif hasattr(o, '__iter__'):
             return list(o)
         else:
             return json.JSONEncoder.default(self, o)
@@ -46,19 +68,35 @@ defn: `dict` with keys being available setting names and values being `dict`s
 Use the `dict` interface to set and retrieve values; delete to reset to the
 default value.  These operations raise `KeyError` for settings not in `defn`.
 
+Changes are saved to disk after a short delay (`MIN_SAVE_INTERVAL`), so that
+rapid changes result in a single save.  Pending changes are saved on exit, or
+by calling `flush`.
+
 """
 
     def __init__ (self, load_fns, save_fn, defn):
         self._log = util.logger('conf.settings')
         self.filename = save_fn
         self.definition = defn
+        # `(validate, cast)` for each setting, looked up on every change
+        self._checks = {key: (item_defn['validate'],
+                              item_defn.get('cast', _identity))
+                        for key, item_defn in defn.items()}
+        # whether there are changes not yet saved to disk
+        self._dirty = False
+        # number of active `batch` contexts
+        self._batch_depth = 0
+        self._save_timer = None
+        self._save_lock = threading.RLock()
+        atexit.register(self.flush)
 
         all_overrides = [self._load(fn) for fn in load_fns]
-        for key, item_defn in defn.items():
-            self[key] = item_defn['default']
-        for overrides in all_overrides:
-            for key, value in overrides.items():
-                self[key] = value
+        with self.batch():
+            for key, item_defn in defn.items():
+                self[key] = item_defn['default']
+            for overrides in all_overrides:
+                for key, value in overrides.items():
+                    self[key] = value
 
     def _load (self, fn):
         # load settings from disk
@@ -77,41 +115,145 @@ default value.  These operations raise `KeyError` for settings not in `defn`.
         else:
             return data
 
-    def _save (self):
+    def _snapshot (self):
+        # copy of the settings which can be serialised while they change
+        # - values may be modified in place without taking the lock, so copy
+        #   mutable containers too; converting to a list happens in one step
+        snapshot = {}
+        for key, value in self.items():
+            if isinstance(value, (set, frozenset, list)):
+                value = list(value)
+            snapshot[key] = value
+        return snapshot
+
+    def _save (self, snapshot):
         # save settings to disk
+        # snapshot: result of `_snapshot`
         fn = self.filename
         tmp_fn = fn + '.tmp'
         os.makedirs(os.path.dirname(fn), exist_ok=True)
-        with open(tmp_fn, 'w') as f:
-            json.dump(self, f, cls=_JSONEncoder)
-        # can't rename if destination exists in Windows
-        try:
-            os.remove(fn)
-        except FileNotFoundError:
-            pass
-        os.rename(tmp_fn, fn)
+        # serialise up-front so the file is written in one go
+        data = json.dumps(snapshot, cls=_JSONEncoder, separators=(',', ':'))
+        with open(tmp_fn, 'wb') as f:
+            f.write(data.encode('utf-8'))
+        # unlike os.rename, overwrites the destination in Windows too
+        os.replace(tmp_fn, fn)
 
-    def __setitem__ (self, key, value):
-        self._log('set', key, value)
-        if key in self.definition:
-            if not self.definition[key]['validate'](value):
-                raise TypeError(value)
-            value = self.definition[key].get('cast', lambda x: x)(value)
+    def _schedule_save (self):
+        # save after a delay, unless a save is already scheduled
+        with self._save_lock:
+            if self._batch_depth or self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(MIN_SAVE_INTERVAL, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
 
-            dict.__setitem__(self, key, value)
+    def flush (self):
+        """Save any pending changes to disk immediately."""
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+            snapshot = self._snapshot()
             try:
-                self._save()
-            except (IOError, OSError, TypeError) as e:
+                self._save(snapshot)
+            except (IOError, OSError, TypeError, ValueError) as e:
                 # NOTE: placeholder is system error message
                 util.warn(_('saving settings failed: {}').format(str(e)))
-        else:
+            else:
+                # only once saved, so a failed save is retried by a later
+                # flush
+                self._dirty = False
+
+    @contextmanager
+    def batch (self):
+        """Context manager that delays saving until the block exits.
+
+Changes made within the block are saved once, on exit.
+
+"""
+        with self._save_lock:
+            self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            with self._save_lock:
+                self._batch_depth -= 1
+                if not self._batch_depth:
+                    self.flush()
+
+    def __setitem__ (self, key, value):
+        self._log('set', key, value)
+        checks = self._checks.get(key)
+        if checks is None:
             raise KeyError(key)
+        validate, cast = checks
+        if not validate(value):
+            raise TypeError(value)
+        new_value = cast(value)
+
+        with self._save_lock:
+            current = self.get(key, _UNSET)
+            # nothing to save if unchanged - but if we were given the stored
+            # object and it's mutable, it may have been modified in place
+            in_place = current is value and not isinstance(value, Hashable)
+            if current == new_value and not in_place:
+                return
+            dict.__setitem__(self, key, new_value)
+            self._dirty = True
+            self._schedule_save()
 
     def __delitem__ (self, key):
         # raises KeyError
         self[key] = self.definition[key]['default']
 
 
+class _LazySettings:
+    """Proxy for a `Settings` instance which is only created when first used.
+
+create: function taking no arguments and returning the `Settings` instance
+
+Supports the `dict` interface and attributes of `Settings`.
+
+"""
+
+    def __init__ (self, create):
+        self._create = create
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def _get (self):
+        # get the instance, creating it if necessary
+        if self._settings is None:
+            with self._lock:
+                if self._settings is None:
+                    self._settings = self._create()
+        return self._settings
+
+    def __getattr__ (self, name):
+        return getattr(self._get(), name)
+
+    def __getitem__ (self, key):
+        return self._get()[key]
+
+    def __setitem__ (self, key, value):
+        self._get()[key] = value
+
+    def __delitem__ (self, key):
+        del self._get()[key]
+
+    def __contains__ (self, key):
+        return key in self._get()
+
+    def __iter__ (self):
+        return iter(self._get())
+
+    def __len__ (self):
+        return len(self._get())
+
+
 def tuple_check (*types):
     """Check a tuple against a template.
 
@@ -121,35 +263,45 @@ Returns a function that takes an object and returns whether it is a lists or
 tuple, has the correct length, and has items with the expected types.
 
 """
+    num_types = len(types)
+
     def check (xs):
         return (isinstance(xs, (list, tuple)) and
-                len(xs) == len(types) and
-                all(isinstance(x, t) for x, t in zip(xs, types)))
+                len(xs) == num_types and
+                all(map(isinstance, xs, types)))
 
     return check
 
 
-settings = Settings(
-    [join_path(path, CONF_FILENAME) for path in PATHS_CONF_READ],
-    join_path(PATH_CONF_WRITE, CONF_FILENAME),
-    {
-        # automatic
-        'win_size_main': {
-            'default': (600, 600),
-            'validate': tuple_check(int, int)
-        },
-        'win_max_main': {
-            'default': False,
-            'validate': lambda x: isinstance(x, bool)
-        },
-        'splitter_ratio_main': {
-            'default': .5,
-            'validate': lambda x: isinstance(x, (int, float)) and 0 <= x <= 1
-        },
-        'disabled_warnings': {
-            'default': set(),
-            'validate': lambda x: hasattr(x, '__iter__'),
-            'cast': lambda x: set(x)
-        }
+_SETTINGS_DEFINITION = {
+    # automatic
+    'win_size_main': {
+        'default': (600, 600),
+        'validate': tuple_check(int, int)
+    },
+    'win_max_main': {
+        'default': False,
+        'validate': lambda x: isinstance(x, bool)
+    },
+    'splitter_ratio_main': {
+        'default': .5,
+        'validate': lambda x: isinstance(x, (int, float)) and 0 <= x <= 1
+    },
+    'disabled_warnings': {
+        'default': set(),
+        'validate': lambda x: hasattr(x, '__iter__'),
+        'cast': lambda x: set(x)
     }
-)
+}
+
+
+def _create_settings ():
+    _create_dirs()
+    return Settings(
+        [join_path(path, CONF_FILENAME) for path in PATHS_CONF_READ],
+        join_path(PATH_CONF_WRITE, CONF_FILENAME),
+        _SETTINGS_DEFINITION)
+
+
+# loaded on first use, so importing this module doesn't touch the disk
+settings = _LazySettings(_create_settings)
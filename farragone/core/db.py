@@ -6,7 +6,10 @@ Foundation, either version 3 of the License, or (at your option) any later
 version."""
 
 import abc
+import itertools
+import functools
 from os.path import join as join_path
+import struct
 import sqlite3
 
 from . import rename
@@ -16,18 +19,81 @@ _tbl = '`temp`'
 
 
 def key_to_sqlite_cmp (key):
-    """Turn a sorting 'key' function into a sqlite3 collation function."""
+    """Turn a sorting 'key' function into a sqlite3 collation function.
+
+Results of `key` are cached, since each value is compared many times while
+sorting.  The returned function has a `clear_cache` attribute, a function to
+call to free the cached results.
+
+"""
+    cache = {}
 
     def cmp_fn (a, b):
         # Python documentation says these arguments should be `bytes`, but
         # they're actually `str`
-        a_cmp = key(a)
-        b_cmp = key(b)
-        return -1 if a_cmp < b_cmp else (0 if a_cmp == b_cmp else 1)
-
+        try:
+            a_cmp = cache[a]
+        except KeyError:
+            a_cmp = cache[a] = key(a)
+        try:
+            b_cmp = cache[b]
+        except KeyError:
+            b_cmp = cache[b] = key(b)
+        return (a_cmp > b_cmp) - (a_cmp < b_cmp)
+
+    cmp_fn.clear_cache = cache.clear
     return cmp_fn
 
 
+def _encode_number (x):
+    # encode an int or float as 8 bytes which compare in the same order
+    if isinstance(x, int) and abs(x) > 2 ** 53:
+        # can't be represented exactly as a float
+        raise OverflowError(x)
+    x = float(x)
+    if x != x:
+        raise ValueError(x)
+    # adding 0 turns -0 into 0, since they're equal
+    b = bytearray(struct.pack('>d', x + 0.))
+    if b[0] & 0x80:
+        # negative: larger magnitudes must give smaller values
+        return bytes(0xff - c for c in b)
+    else:
+        b[0] |= 0x80
+        return bytes(b)
+
+
+def _encode_key_item (item):
+    # encode a tuple item so that it doesn't depend on the following items
+    if isinstance(item, str):
+        # NUL is escaped so that the terminator sorts before any character
+        return (item.encode('utf-8', 'surrogatepass').replace(b'\0', b'\0\xff')
+                + b'\0\0')
+    else:
+        return _encode_number(item)
+
+
+def encode_sort_key (key):
+    """Encode a value returned by a sorting 'key' function as `bytes` which
+compare (bytewise) in the same order.
+
+key: string, number or tuple of strings and numbers
+
+Raises `TypeError`, `ValueError` or `OverflowError` for keys which can't be
+encoded.
+
+"""
+    if isinstance(key, str):
+        # UTF-8 preserves code point order
+        return key.encode('utf-8', 'surrogatepass')
+    elif isinstance(key, tuple):
+        # items encode to values which are never prefixes of each other, so a
+        # shorter tuple sorts first, as in Python
+        return b''.join(map(_encode_key_item, key))
+    else:
+        return _encode_number(key)
+
+
 def _mk_select (where):
     """Return a `select` SQL query.
 
@@ -48,6 +114,18 @@ init: initialisation function run after opening the connection and before
 
 """
 
+    # query string used to configure the connection (multiple queries allowed)
+    # - the database is discarded when closed, so durability isn't needed
+    # - each connection has its own database, so locks are never contended
+    # - cache size is in KiB when negative; a larger cache means less of the
+    #   database is moved to a temp file
+    _PRAGMA_QUERY = '''
+PRAGMA locking_mode = EXCLUSIVE;
+PRAGMA journal_mode = MEMORY;
+PRAGMA synchronous = OFF;
+PRAGMA temp_store = MEMORY;
+PRAGMA cache_size = -65536;
+'''
     # query string used to initialise the database (multiple queries allowed)
     _CREATE_QUERY = None
     # queries by identifier
@@ -60,7 +138,12 @@ init: initialisation function run after opening the connection and before
         # stored in memory or temp file, depending on available memory
         # creates a different database for each connection
         # https://www.sqlite.org/inmemorydb.html
-        self.con = sqlite3.connect('')
+        self.con = sqlite3.connect('', cached_statements=256)
+        self.con.executescript(self._PRAGMA_QUERY)
+        # formatted query strings, by `(qry_id, options)`
+        self._formatted_queries = {}
+        # for queries whose results are used immediately
+        self._cursor = self.con.cursor()
         if init:
             init()
         self._setup()
@@ -70,21 +153,51 @@ init: initialisation function run after opening the connection and before
         if self.con is not None:
             self.con.close()
             self.con = None
+            self._cursor = None
+
+    def _query (self, qry_id, options={}):
+        """Get a query string.
+
+qry_id: key in `self._QUERIES`
+options: passed to `str.format` on the query string
+
+The result is cached for each set of options.
 
-    def _exec (self, qry_id, params=(), options={}):
+"""
+        cache_key = (qry_id, tuple(sorted(options.items())))
+        qry = self._formatted_queries.get(cache_key)
+        if qry is None:
+            qry = self._QUERIES[qry_id].format(**options)
+            self._formatted_queries[cache_key] = qry
+        return qry
+
+    def _exec (self, qry_id, params=(), options={}, cursor=None):
         """Execute an SQL query.
 
 qry_id: key in `self._QUERIES`
 params: sequence or dict of parameters to substitute into the query
 options: passed to `str.format` on the query string
+cursor: cursor to use; by default, a new cursor is created, so results can be
+        read while other queries run
 
 Returns the cursor used to execute the query.
 
 """
-        cursor = self.con.cursor()
-        cursor.execute(self._QUERIES[qry_id].format(**options), params)
+        if cursor is None:
+            cursor = self.con.cursor()
+        cursor.execute(self._query(qry_id, options), params)
         return cursor
 
+    def _exec_many (self, qry_id, params_seq, options={}):
+        """Execute an SQL query once for each set of parameters.
+
+qry_id: key in `self._QUERIES`
+params_seq: sequence of parameters, each as taken by `_exec`
+options: passed to `str.format` on the query string
+
+"""
+        self.con.executemany(self._query(qry_id, options), params_seq)
+
     def _setup (self):
         """Initialise the database tables."""
         self.con.executescript(self._CREATE_QUERY)
@@ -107,31 +220,46 @@ CREATE INDEX `cmp_to` ON {tbl} (`cmp_to`);
     _QUERIES = {}
     _QUERIES.update(DB._QUERIES)
     _QUERIES.update({
-        'add': 'INSERT INTO {tbl} VALUES (:frm, :to, :cmp_frm, :cmp_to)',
+        'add': 'INSERT INTO {tbl} VALUES (?, ?, ?, ?)',
         'find frm': _mk_select('`cmp_frm` = ?'),
         'find to': _mk_select('`cmp_to` = ?'),
         # collation defaults to BINARY, so these comparisons are
         # case-insensitive
         'find frm parent': _mk_select('`cmp_frm` IN ({parents})'),
-        'find frm child': _mk_select('? < `cmp_frm` AND `cmp_frm` < ?')
+        'find frm child': _mk_select('? < `cmp_frm` AND `cmp_frm` < ?'),
     })
+    # all 'find' queries at once, each result tagged with its index in
+    # `find_all`'s result
+    _QUERIES['find all'] = '''
+    SELECT 0, * FROM ({0})
+    UNION ALL SELECT 1, * FROM ({1})
+    UNION ALL SELECT 2, * FROM ({2})
+    UNION ALL SELECT 3, * FROM ({3})
+'''.format(_QUERIES['find frm'], _QUERIES['find to'],
+           _QUERIES['find frm child'], _QUERIES['find frm parent'])
 
     def __init__ (self):
+        # 'find frm parent' query strings by number of parents
+        self._parent_queries = {}
+        # 'find all' query strings by number of parents
+        self._find_all_queries = {}
         DB.__init__(self)
 
 
-    def add (self, frm, to):
+    def add (self, frm, to, cmp_frm=None, cmp_to=None):
         """Add a rename to the database.
 
 frm: source path
 to: destination path
+cmp_frm, cmp_to: comparable versions of `frm` and `to`, if already computed
 
 """
-        self._exec('add', {
-            'frm': frm, 'to': to,
-            'cmp_frm': rename.comparable_path(frm),
-            'cmp_to': rename.comparable_path(to)
-        }, {'tbl': self._tbl})
+        if cmp_frm is None:
+            cmp_frm = rename.comparable_path(frm)
+        if cmp_to is None:
+            cmp_to = rename.comparable_path(to)
+        self._exec('add', (frm, to, cmp_frm, cmp_to), {'tbl': self._tbl},
+                   self._cursor)
 
 
     def _get_one (self, qry_id, params=(), options={}):
@@ -145,7 +273,7 @@ Returns a database record or `None`.
 """
         options = options.copy()
         options.setdefault('tbl', self._tbl)
-        return next(self._exec(qry_id, params, options), None)
+        return self._exec(qry_id, params, options, self._cursor).fetchone()
 
 
     def find_frm (self, cmp_frm):
@@ -180,9 +308,16 @@ Returns `(frm, to)` or `None`.
 
 """
         parents = tuple(rename.parents(cmp_child))
-        return self._get_one('find frm parent', parents, {
-            'parents': ', '.join('?' * len(parents))
-        })
+        # the query depends only on the number of parents, so look it up
+        # directly rather than formatting it every time
+        qry = self._parent_queries.get(len(parents))
+        if qry is None:
+            qry = self._query('find frm parent', {
+                'tbl': self._tbl,
+                'parents': ', '.join('?' * len(parents))
+            })
+            self._parent_queries[len(parents)] = qry
+        return self._cursor.execute(qry, parents).fetchone()
 
 
     def find_frm_child (self, cmp_parent):
@@ -194,20 +329,62 @@ cmp_parent: comparable source path to search for children of
 Returns `(frm, to)` or `None`.
 
 """
+        return self._get_one('find frm child', self._child_bounds(cmp_parent))
+
+
+    @staticmethod
+    def _child_bounds (cmp_parent):
+        # `(lower, upper)` exclusive bounds on comparable paths of children
         child_lb = join_path(cmp_parent, '')
         child_ub = child_lb[:-1] + chr(ord(child_lb[-1]) + 1)
-        return self._get_one('find frm child', (child_lb, child_ub))
+        return (child_lb, child_ub)
+
+
+    def find_all (self, cmp_frm, cmp_to):
+        """Run all `find_*` queries for a rename at once.
+
+cmp_frm: comparable source path
+cmp_to: comparable destination path
+
+Returns `(same_frm, same_to, frm_child, frm_parent)`, the results of
+`find_frm(cmp_frm)`, `find_to(cmp_to)`, `find_frm_child(cmp_frm)` and
+`find_frm_parent(cmp_frm)`.
+
+"""
+        parents = tuple(rename.parents(cmp_frm))
+        qry = self._find_all_queries.get(len(parents))
+        if qry is None:
+            qry = self._query('find all', {
+                'tbl': self._tbl,
+                'parents': ', '.join('?' * len(parents))
+            })
+            self._find_all_queries[len(parents)] = qry
+
+        params = (cmp_frm, cmp_to) + self._child_bounds(cmp_frm) + parents
+        results = [None] * 4
+        for i, frm, to in self._cursor.execute(qry, params):
+            results[i] = (frm, to)
+        return tuple(results)
 
 
 class OrderingDB (DB):
     # we read into one table, then copy into another with the desired order,
     # then read from that sorted by original order
+    # - we sort by sort keys encoded by `encode_sort_key`, if possible, since
+    #   that avoids calling back into Python for every comparison
     _tbl_opts = {'tbl1': '`temp1`', 'tbl2': '`temp2`'}
     _collation = 'custom_collation'
+    # number of paths to store up before inserting them together
+    _ADD_BATCH_SIZE = 512
+    # up to this many paths are sorted in memory, without using the database
+    _MEMORY_SORT_SIZE = 4096
+    # number of sorted paths to retrieve at once
+    _FETCH_SIZE = 1024
 
     _CREATE_QUERY = '''
-CREATE TABLE {tbl1} (`path` TEXT COLLATE {collation}, `full_path` TEXT);
-CREATE INDEX `path` ON {tbl1} (`path`);
+CREATE TABLE {tbl1} (
+    `path` TEXT COLLATE {collation}, `sort_key` BLOB, `full_path` TEXT
+);
 CREATE TABLE {tbl2} (`order` INTEGER, `full_path` TEXT);
 CREATE INDEX `order` ON {tbl2} (`order`);
 '''.format(collation=_collation, **_tbl_opts)
@@ -215,21 +392,31 @@ CREATE INDEX `order` ON {tbl2} (`order`);
     _QUERIES = {}
     _QUERIES.update(DB._QUERIES)
     _QUERIES.update({
-        'add': 'INSERT INTO {tbl1} VALUES (:path, :full_path)',
+        'add': 'INSERT INTO {tbl1} VALUES (?, ?, ?)',
         'sort': '''
     INSERT INTO {tbl2} SELECT ROWID, `full_path` FROM {tbl1}
-        ORDER BY `path` {order}
+        ORDER BY {sort_col} {order}, ROWID {order}
 ''',
         'get sorted': 'SELECT ROWID, `full_path` FROM {tbl2} ORDER BY `order`'
     })
 
     def __init__ (self, key, reverse):
         self.reverse = reverse
-        DB.__init__(self, tuple(self._tbl_opts.values()),
-                    lambda: self._init(key_to_sqlite_cmp(key)))
-
-    def _init (self, cmp_fn):
-        self.con.create_collation(self._collation, cmp_fn)
+        # paths often share sort values (eg. the same directory), and some key
+        # functions (eg. locale.strxfrm) are slow
+        self._key = functools.lru_cache(maxsize=4096)(key)
+        # whether all sort keys so far could be encoded
+        self._keys_encoded = True
+        self._add_buffer = []
+        # whether any paths have been inserted into the database
+        self._stored_in_db = False
+        # sorted indices, in the order paths were added, if sorted in memory
+        self._ranks = None
+        self._cmp_fn = key_to_sqlite_cmp(key)
+        DB.__init__(self, tuple(self._tbl_opts.values()), self._init)
+
+    def _init (self):
+        self.con.create_collation(self._collation, self._cmp_fn)
 
     def add (self, path, full_path):
         """Add a path to the store.
@@ -238,15 +425,64 @@ path: to use in sorting
 full_path: original path, to yield in `get_sorted`
 
 """
-        self._exec('add', {
-            'path': path,
-            'full_path': full_path
-        }, options=self._tbl_opts)
+        sort_key = None
+        if self._keys_encoded:
+            try:
+                sort_key = encode_sort_key(self._key(path))
+            except (TypeError, ValueError, OverflowError):
+                # fall back to sorting using the collation
+                self._keys_encoded = False
+
+        # `(path, sort_key, full_path)`, matching the table's columns
+        self._add_buffer.append((path, sort_key, full_path))
+        if len(self._add_buffer) >= (self._ADD_BATCH_SIZE if self._stored_in_db
+                                     else self._MEMORY_SORT_SIZE):
+            self._flush_added()
+
+    def _flush_added (self):
+        # insert paths stored up by `add`
+        if self._add_buffer:
+            self._exec_many('add', self._add_buffer, options=self._tbl_opts)
+            self._add_buffer = []
+            self._stored_in_db = True
+
+    def clear (self):
+        self._keys_encoded = True
+        self._add_buffer = []
+        self._stored_in_db = False
+        self._ranks = None
+        DB.clear(self)
+
+    def _sort_in_memory (self):
+        # sort paths stored up by `add`, which are all of them
+        rows = self._add_buffer
+        if self._keys_encoded:
+            sort_keys = [sort_key for path, sort_key, full_path in rows]
+        else:
+            key = self._key
+            sort_keys = [key(path) for path, sort_key, full_path in rows]
+        # stable, so equal paths stay in the order they were added; when
+        # reversed, the whole order is reversed, including equal paths, as in
+        # the database
+        order = sorted(range(len(rows)), key=sort_keys.__getitem__)
+        if self.reverse:
+            order.reverse()
+        ranks = [0] * len(rows)
+        for rank, i in enumerate(order, 1):
+            ranks[i] = rank
+        self._ranks = ranks
 
     def sort (self):
         # sort stored paths internally
+        if not self._stored_in_db:
+            self._sort_in_memory()
+            return
+        self._flush_added()
         order = 'DESC' if self.reverse else 'ASC'
-        self._exec('sort', options=dict(self._tbl_opts, order=order))
+        sort_col = '`sort_key`' if self._keys_encoded else '`path`'
+        self._exec('sort', options=dict(self._tbl_opts, order=order,
+                                        sort_col=sort_col))
+        self._cmp_fn.clear_cache()
 
     def get_sorted (self):
         """Retrieve sorted paths (`get_sorted` must have been called).
@@ -255,4 +491,9 @@ Returns an iterator of `(index, full_path)` tuples, with `index` starting at 1,
 and `full_path` as passed to `add`, in the same order as calls to `add`.
 
 """
-        return self._exec('get sorted', options=self._tbl_opts)
+        if self._ranks is not None:
+            return zip(self._ranks, (full_path for path, sort_key, full_path
+                                     in self._add_buffer))
+        cursor = self._exec('get sorted', options=self._tbl_opts)
+        cursor.arraysize = self._FETCH_SIZE
+        return itertools.chain.from_iterable(iter(cursor.fetchmany, []))
@@ -5,14 +5,36 @@ the terms of the GNU General Public License as published by the Free Software
 Foundation, either version 3 of the License, or (at your option) any later
 version."""
 
+import sys
 import abc
 import itertools
-from collections import Counter
+import functools
 import math
 import re
 from os import path as os_path
 import locale
 
+try:
+    # no longer public since 3.11
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+try:
+    import re2
+    # the google-re2 module's way of matching case-insensitively
+    _re2_options = re2.Options()
+    _re2_options.case_sensitive = False
+    # unsupported patterns are compiled with another module instead, so
+    # failing isn't worth logging
+    _re2_options.log_errors = False
+except Exception:
+    # not installed, or not the module we expect
+    re2 = None
+try:
+    import regex as regex_module
+except ImportError:
+    regex_module = None
+
 from .. import util
 from . import db
 
@@ -118,17 +140,17 @@ May be called with a path to return the relevant part.
 
 Attributes:
 
-name, desc: as passed to the contstructor
+name, f, desc: as passed to the contstructor
 
 """
 
     def __init__ (self, name, f, desc):
         self.name = name
         self.desc = desc
-        self._f = f
+        self.f = f
 
     def __call__ (self, path):
-        return self._f(path)
+        return self.f(path)
 
 
 # `Context` instances enum
@@ -138,9 +160,9 @@ class Contexts:
                    # NOTE: as in file path
                    _('The full path'))
     # NOTE: as in file/directory name
-    NAME = Context(_('Name'), lambda path: os_path.basename(path),
+    NAME = Context(_('Name'), os_path.basename,
                    _('Just the name of the file or directory'))
-    DIR = Context(_('Directory'), lambda path: os_path.dirname(path),
+    DIR = Context(_('Directory'), os_path.dirname,
                   _('The path excluding the filename'))
 
 
@@ -148,6 +170,83 @@ class Contexts:
 all_contexts = (Contexts.NAME, Contexts.PATH, Contexts.DIR)
 
 
+# syntax which the `regex` module reads differently from `re`, or which only
+# `regex` supports:
+# - POSIX classes, eg. '[[:digit:]]', which are a nested set in `re`
+# - Unicode properties and '(?<name>...)' groups
+# - braces which aren't a plain repeat count, eg. fuzzy matching '{e<=1}',
+#   which `re` reads literally
+_regex_unsafe_pattern = re.compile(
+    r'\[:|\\[pP]|\(\?<(?![=!])|\{(?!\d+(?:,\d*)?\})')
+# as `_regex_unsafe_pattern`, for `re2`; also:
+# - character classes which are Unicode-aware in `re` but ASCII-only in `re2`
+# - '$', which `re` also matches before a trailing newline
+# - lookbehind, which `re2` doesn't support
+_re2_unsafe_pattern = re.compile(
+    _regex_unsafe_pattern.pattern + r'|\\[wWdDsSbB]|\$|\(\?<')
+
+
+def _required_literal (pattern):
+    """Find a string that must appear in anything a pattern matches.
+
+pattern: regular expression as a string, in `re` syntax
+
+Only characters unaffected by case-insensitive matching are considered.
+Returns the longest such string at the top level of the pattern, or `None`.
+
+"""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except Exception:
+        # eg. syntax only supported by another engine
+        return None
+
+    literals = ['']
+    for op, arg in parsed:
+        if op is sre_parse.LITERAL:
+            c = chr(arg)
+            if c.lower() == c == c.upper():
+                literals[-1] += c
+                continue
+        literals.append('')
+    literal = max(literals, key=len)
+    return literal if literal else None
+
+
+# cached, since the same pattern is compiled again whenever field sources are
+# rebuilt, eg. while editing other settings
+@functools.lru_cache(maxsize=128)
+def _compile_regex (pattern):
+    """Compile a regular expression for matching paths, case-insensitively.
+
+Uses the `re2` module if it's available and matches the same way for the
+pattern, since it runs in linear time; otherwise the `regex` module under the
+same condition, since it's generally faster; otherwise `re`.
+
+Returns `(engine, compiled)`, where `engine` is the module used.  Raises
+`re.error` if the pattern is invalid.
+
+"""
+    # always compile with `re`, so invalid patterns give the same errors
+    compiled = re.compile(pattern, re.IGNORECASE)
+    if re2 is not None and _re2_unsafe_pattern.search(pattern) is None:
+        try:
+            return (re2, re2.compile(pattern, _re2_options))
+        except Exception:
+            # unsupported features, eg. backreferences; not necessarily
+            # `re2.error`, so fall back to the other modules for anything
+            pass
+    if (regex_module is not None and
+        _regex_unsafe_pattern.search(pattern) is None):
+        try:
+            # version 0 behaviour is mostly compatible with `re`
+            flags = regex_module.IGNORECASE | regex_module.V0
+            return (regex_module, regex_module.compile(pattern, flags))
+        except regex_module.error:
+            pass
+    return (re, compiled)
+
+
 class Fields (metaclass=abc.ABCMeta):
     """Retrieve fields from a file (abstract base class)."""
 
@@ -203,6 +302,17 @@ class SimpleEvalFields (Fields, metaclass=abc.ABCMeta):
         """Return a `dict` of fields for the given path."""
         pass
 
+    def context_evaluator (self):
+        """Get a function for evaluating fields from part of a path.
+
+Returns `(context, evaluate)`, where `evaluate` takes the result of calling the
+`Context` instance `context` with a path, and returns a `dict` like
+`evaluate_one`.  `context` may be `None`, in which case `evaluate` takes the
+full path.
+
+"""
+        return (None, self.evaluate_one)
+
     def evaluate (self, paths, interrupt=None):
         eval_one = self.evaluate_one
         return (((path, eval_one(path)) for path in paths), None)
@@ -282,13 +392,24 @@ duplicate_names: `set` of field names occuring more than once
             else:
                 sets.append(fields)
 
-        names = Counter(itertools.chain.from_iterable(
-            fields.names for fields in sets))
-        self._names = list(names.keys())
+        names = []
+        seen_names = set()
+        duplicate_names = set()
+        for name in itertools.chain.from_iterable(
+            fields.names for fields in sets
+        ):
+            if name in seen_names:
+                duplicate_names.add(name)
+            else:
+                seen_names.add(name)
+                names.append(name)
+        self._names = names
         self.field_sets = sets if sets else [NoFields()]
 
         self._warnings = []
-        self.duplicate_names = frozenset(+(names - Counter(set(names))))
+        # all warnings, including those from field sets, once collected
+        self._all_warnings = None
+        self.duplicate_names = frozenset(duplicate_names)
         if self.duplicate_names:
             detail = _('duplicate field names: {}').format(
                 ', '.join(map(repr, self.duplicate_names)))
@@ -300,8 +421,37 @@ duplicate_names: `set` of field names occuring more than once
 
     @property
     def warnings (self):
-        # don't include Fields warnings, since each of field_sets will
-        return sum((f.warnings for f in self.field_sets), []) + self._warnings
+        # field sets don't change, so their warnings are only collected once
+        if self._all_warnings is None:
+            # don't include Fields warnings, since each of field_sets will
+            self._all_warnings = list(itertools.chain.from_iterable(
+                f.warnings for f in self.field_sets))
+            self._all_warnings.extend(self._warnings)
+        return list(self._all_warnings)
+
+    @staticmethod
+    def _simple_evaluator (simple):
+        # get a function taking a path and a `dict` to update with fields from
+        # the `SimpleEvalFields` instances `simple`; field sets with the same
+        # context share the part of the path it gives
+        context_fns = []
+        evaluators = []
+        for fields in simple:
+            context, evaluate = fields.context_evaluator()
+            if context is None:
+                evaluators.append((None, evaluate))
+            else:
+                if context.f not in context_fns:
+                    context_fns.append(context.f)
+                evaluators.append((context_fns.index(context.f), evaluate))
+
+        def eval_simple (path, combined_result):
+            parts = [context_fn(path) for context_fn in context_fns]
+            for context_idx, evaluate in evaluators:
+                combined_result.update(evaluate(
+                    path if context_idx is None else parts[context_idx]))
+
+        return eval_simple
 
     def evaluate (self, paths, interrupt=None):
         cplx = [fields for fields in self.field_sets
@@ -310,47 +460,50 @@ duplicate_names: `set` of field names occuring more than once
                   if not isinstance(fields, ComplexEvalFields)]
         states = {}
 
-        # sets path_vals
-        if cplx:
-            cplx_path_iters = itertools.tee(paths, len(cplx))
-            store_iters = []
-            for fields, path_iter in zip(cplx, cplx_path_iters):
-                store_iter, state = fields.store(path_iter)
-                store_iters.append(store_iter)
-                states[fields] = state
-            util.consume(zip(*store_iters), interrupt)
+        if not cplx and len(simple) == 1:
+            # nothing to merge
+            results, states[simple[0]] = simple[0].evaluate(paths, interrupt)
+            return (results, states)
 
-            first = cplx.pop()
-            path_vals = first.evaluate_stored(states[first])
+        eval_simple = self._simple_evaluator(simple)
 
-        else:
-            path_vals = ((path, {}) for path in paths)
-
-        # sets first_path_vals, simple_results
-        if simple:
-            first_path_vals, simple_path_vals = itertools.tee(path_vals, 2)
-            path_iters = itertools.tee((path for path, val in simple_path_vals),
-                                       len(simple))
-            simple_results = []
-            for fields, path_iter in zip(simple, path_iters):
-                single_results, state = fields.evaluate(path_iter)
-                simple_results.append(single_results)
-                states[fields] = state
+        if not cplx:
+            def get ():
+                # single pass over paths, evaluating each field set in turn
+                for path in paths:
+                    combined_result = {}
+                    eval_simple(path, combined_result)
+                    yield (path, combined_result)
+
+            return (get(), states)
 
+        if len(cplx) == 1:
+            store_iter, states[cplx[0]] = cplx[0].store(paths)
         else:
-            first_path_vals = path_vals
-            simple_results = []
+            # store each path in all field sets in turn, rather than teeing
+            # the paths
+            stores = []
+            for fields in cplx:
+                states[fields] = state = fields.init_store()
+                stores.append((fields.store_one, state))
+            store_iter = (store_one(state, path)
+                          for path in paths for store_one, state in stores)
+        util.consume(store_iter, interrupt)
 
+        first = cplx.pop()
+        first_path_vals = first.evaluate_stored(states[first])
         cplx_results = [fields.evaluate_stored(states[fields])
                         for fields in cplx]
 
         def get ():
-            for results in zip(first_path_vals,
-                               *(simple_results + cplx_results)):
-                combined_result = {}
-                for path, result in results:
+            # simple fields are evaluated using paths from the first complex
+            # fields' results, which are in the original order
+            for results in zip(first_path_vals, *cplx_results):
+                path, combined_result = results[0]
+                eval_simple(path, combined_result)
+                for cplx_path, result in results[1:]:
                     combined_result.update(result)
-                yield (results[0][0], combined_result)
+                yield (path, combined_result)
 
         return (get(), states)
 
@@ -383,13 +536,21 @@ index: as passed to the constructor
 """
 
     def __init__ (self, field_name, index=-1):
-        self._name = field_name
+        # used as a key in the result for every path
+        self._name = sys.intern(field_name)
         index_valid = True
         try:
             self.index = int(index)
         except ValueError:
             index_valid = False
             self.index = -1
+        # `(directory, components)` for the last path's parent directory
+        self._last_dir = (None, None)
+        if self.index == -1:
+            # the common case, and doesn't need the path split up
+            self.evaluate_one = self._evaluate_name
+        elif self.index >= 0:
+            self.evaluate_one = self._evaluate_leading
 
         self._warnings = []
         if not index_valid:
@@ -410,11 +571,47 @@ index: as passed to the constructor
     def warnings (self):
         return Fields.warnings.fget(self) + self._warnings
 
-    def evaluate_one (self, full_path):
+    def _evaluate_name (self, full_path):
+        # `evaluate_one` for the last component
+        return {self._name: os_path.basename(full_path)}
+
+    def evaluate (self, paths, interrupt=None):
+        if self.index != -1:
+            return SimpleEvalFields.evaluate(self, paths, interrupt)
+        # the common case; bind values used for every path to locals
+        name = self._name
+        basename = os_path.basename
+        return (((path, {name: basename(path)}) for path in paths), None)
+
+    def _evaluate_leading (self, full_path):
+        # `evaluate_one` for non-negative indices; only splits the path as far
+        # as the component we want
+        index = self.index
         drive, path = os_path.splitdrive(full_path)
-        components = [drive]
+        if not index:
+            return {self._name: drive}
         # absolute, so splitdrive always gives path starting with separator
-        components.extend(path.split(os_path.sep)[1:])
+        components = path.split(os_path.sep, index + 1)
+        try:
+            component = components[index]
+        except IndexError:
+            return {}
+        else:
+            return {self._name: component}
+
+    def evaluate_one (self, full_path):
+        dir_path, name = os_path.split(full_path)
+        cached_dir, dir_components = self._last_dir
+        if dir_path == cached_dir:
+            # consecutive paths are often in the same directory
+            components = dir_components + [name]
+        else:
+            drive, path = os_path.splitdrive(full_path)
+            components = [drive]
+            # absolute, so splitdrive always gives path starting with separator
+            components.extend(path.split(os_path.sep)[1:])
+            self._last_dir = (dir_path, components[:-1])
+
         try:
             component = components[self.index]
         except IndexError:
@@ -448,14 +645,21 @@ regex: compiled regular expression
 
     def __init__ (self, pattern, field_name_prefix, context=Contexts.NAME):
         pattern_err = None
+        # pattern `regex` is compiled from
+        compiled_pattern = pattern
         try:
-            regex = re.compile(pattern, re.IGNORECASE)
+            engine, regex = _compile_regex(pattern)
         except re.error as e:
             pattern_err = e
-            regex = re.compile('')
-
-        self._field_name_prefix = field_name_prefix
-        names = list(map(self._field_name, range(regex.groups)))
+            compiled_pattern = ''
+            engine, regex = _compile_regex(compiled_pattern)
+
+        # used as keys in the result for every path
+        self._field_name_prefix = sys.intern(field_name_prefix)
+        # field names for positional groups, in order
+        self._group_names = tuple(
+            sys.intern(self._field_name(i)) for i in range(regex.groups))
+        names = list(self._group_names)
         # no fields for positional groups if prefix is empty
         if field_name_prefix:
             names.append(field_name_prefix)
@@ -464,6 +668,10 @@ regex: compiled regular expression
         self.pattern = pattern
         self.regex = regex
         self.context = context
+        # module used to compile `regex`
+        self._engine = engine
+        self._compiled_pattern = compiled_pattern
+        self._evaluate_context = self._context_evaluator()
 
         self._warnings = []
 
@@ -474,13 +682,22 @@ regex: compiled regular expression
                 repr(pattern), util.exc_str(pattern_err)
             )))
 
-        extra_names = Counter(names) - Counter(set(names))
+        seen_names = set()
+        duplicate_names = set()
+        for name in names:
+            if name in seen_names:
+                duplicate_names.add(name)
+            else:
+                seen_names.add(name)
+        # in order of first occurrence
+        extra_names = [name for name in dict.fromkeys(names)
+                       if name in duplicate_names]
         if extra_names:
             # NOTE: warning detail for an invalid field source; placeholders are
             # the duplicated field names and a description of the field source
             detail = _(
                 'duplicate field names: {0} ({1})'
-            ).format(', '.join(map(repr, extra_names.keys())), self)
+            ).format(', '.join(map(repr, extra_names)), self)
             self._warnings.append(util.Warn('fields', detail))
 
     def __str__ (self):
@@ -499,23 +716,76 @@ regex: compiled regular expression
         # get the field name for a group by index
         return self._field_name_prefix + str(idx + 1)
 
-    def evaluate_one (self, path):
-        matches = self.regex.finditer(self.context(path))
-        try:
-            match = next(matches)
-        except StopIteration:
-            return {}
+    def _context_evaluator (self):
+        # get a function like `evaluate_one`, but taking the part of the path
+        # given by `context`; values used for every path are bound to locals
+        search = self.regex.search
+        prefix = self._field_name_prefix
+        group_names = self._group_names
+        # `groupdict` builds a new `dict` even if there are no named groups
+        has_named_groups = bool(self.regex.groupindex)
+
+        if not self.regex.groups:
+            # the only possible field is the whole match
+            if not prefix:
+                return lambda s: {}
+
+            def evaluate (s):
+                match = search(s)
+                return {} if match is None else {prefix: match.group(0)}
+
+        elif not prefix:
+            # only named groups give fields
+            if not has_named_groups:
+                return lambda s: {}
+
+            def evaluate (s):
+                match = search(s)
+                return {} if match is None else match.groupdict()
+
+        elif not has_named_groups:
+            def evaluate (s):
+                match = search(s)
+                if match is None:
+                    return {}
+                fields = dict(zip(group_names, match.groups()))
+                fields[prefix] = match.group(0)
+                return fields
+
         else:
-            fields = {}
-            if self._field_name_prefix:
-                fields.update({self._field_name(i): field
-                               for i, field in enumerate(match.groups())})
-                try:
-                    fields[self._field_name_prefix] = match.group(0)
-                except IndexError:
-                    pass
-            fields.update(match.groupdict())
-            return fields
+            def evaluate (s):
+                match = search(s)
+                if match is None:
+                    return {}
+                fields = dict(zip(group_names, match.groups()))
+                fields[prefix] = match.group(0)
+                fields.update(match.groupdict())
+                return fields
+
+        # the literal is found using `re`'s parser, which may misread syntax
+        # specific to other modules
+        literal = (_required_literal(self._compiled_pattern)
+                   if self._engine is re else None)
+        if literal is not None:
+            # checking for a substring is much quicker than searching
+            search_evaluate = evaluate
+
+            def evaluate (s):
+                return search_evaluate(s) if literal in s else {}
+
+        return evaluate
+
+    def evaluate_one (self, path):
+        return self._evaluate_context(self.context(path))
+
+    def context_evaluator (self):
+        return (self.context, self._evaluate_context)
+
+    def evaluate (self, paths, interrupt=None):
+        # call the context function directly, skipping `Context.__call__`
+        context = self.context.f
+        eval_context = self._evaluate_context
+        return (((path, eval_context(context(path))) for path in paths), None)
 
 
 class Ordering (ComplexEvalFields):
@@ -539,7 +809,8 @@ key, reverse, context, fmt: as passed to the constructor
 
     def __init__ (self, field_name, key=SortTypes.alphabetical, reverse=False,
                   context=Contexts.NAME, fmt=str):
-        self._name = field_name
+        # used as a key in the result for every path
+        self._name = sys.intern(field_name)
         self.key = key
         self.reverse = reverse
         self.context = context
@@ -590,6 +861,16 @@ For use as the `fmt` argument to the constructor
     def store_one (self, odb, path):
         odb.add(self.context(path), path)
 
+    def store (self, paths):
+        # avoid `store_one` and `Context.__call__`, since this is called for
+        # every path
+        odb = self.init_store()
+        add = odb.add
+        if self.context is Contexts.PATH:
+            return ((add(path, path) for path in paths), odb)
+        context = self.context.f
+        return ((add(context(path), path) for path in paths), odb)
+
     def evaluate_stored (self, odb):
         odb.sort()
         fmt = self.fmt
@@ -11,6 +11,8 @@ import os
 from glob import iglob
 
 glob_chars = re.compile('([*?[])')
+# no os.scandir until 3.5
+_scandir = getattr(os, 'scandir', None)
 
 
 # no glob.escape until 3.4
@@ -20,6 +22,43 @@ def escape_glob (path):
     return drive + glob_chars.sub(r'[\1]', path)
 
 
+def _walk_files (top):
+    """Recursively find files in a directory.
+
+top: directory to search
+
+Yields paths to non-directories, in the same order as `os.walk` would give
+them.  Like `os.walk`, symbolic links to directories are not followed, and
+directories that can't be read are skipped.  Uses `os.scandir` directly, so we
+don't build lists of names for every directory.
+
+"""
+    stack = [top]
+    while stack:
+        try:
+            entries = list(_scandir(stack.pop()))
+        except OSError:
+            continue
+
+        dirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                yield entry.path
+            else:
+                try:
+                    is_link = entry.is_symlink()
+                except OSError:
+                    is_link = False
+                if not is_link:
+                    dirs.append(entry.path)
+        # depth-first, in listing order
+        stack.extend(reversed(dirs))
+
+
 class Input (metaclass=abc.ABCMeta):
     """Defines a method for retrieving input paths."""
 
@@ -63,11 +102,22 @@ pattern: as passed to the constructor
     def __init__ (self, pattern, cwd=None):
         if cwd is None:
             cwd = os.getcwd()
-        self.pattern = os.path.join(escape_glob(cwd),
-                                    os.path.expanduser(pattern))
+        pattern = os.path.expanduser(pattern)
+        self.pattern = os.path.join(escape_glob(cwd), pattern)
+        # the only path that can match, if `pattern` has no wildcards
+        self._literal_path = (None if glob_chars.search(pattern) is not None
+                              else os.path.join(cwd, pattern))
 
     def __iter__ (self):
-        return iglob(self.pattern)
+        path = self._literal_path
+        if path is None:
+            return iglob(self.pattern)
+        # like `iglob`, but without matching against an escaped `cwd`
+        if os.path.basename(path):
+            exists = os.path.lexists(path)
+        else:
+            exists = os.path.isdir(path)
+        return iter((path,) if exists else ())
 
 
 class RecursiveFilesInput (Input):
@@ -89,6 +139,8 @@ path: as passed to the constructor
     def __iter__ (self):
         if os.path.isfile(self.path):
             yield self.path
+        elif _scandir is not None:
+            yield from _walk_files(self.path)
         else:
             join = os.path.join
             # doesn't throw
@@ -7,14 +7,22 @@ Foundation, either version 3 of the License, or (at your option) any later
 version."""
 
 import itertools
+import functools
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 from .. import conf, util
 
 
+# maps Windows path separators to '/' with `str.translate`
+_SEP_TABLE = str.maketrans(os.sep, '/')
+
+
+# cached, since warnings for clashing renames show the same paths repeatedly
+@functools.lru_cache(maxsize=1024)
 def fmt_path (path):
-    return repr(path.replace(os.sep, '/') if conf.WINDOWS else path)
+    return repr(path.translate(_SEP_TABLE) if conf.WINDOWS else path)
 
 
 def preview_rename (frm, to):
@@ -24,7 +32,8 @@ def preview_rename (frm, to):
 
 
 # given a file path, return one that can be safely compared to others
-comparable_path = os.path.normcase
+# - cached, since the same paths are compared many times when checking renames
+comparable_path = functools.lru_cache(maxsize=4096)(os.path.normcase)
 
 
 def _get_abs_path (path, cwd):
@@ -34,8 +43,68 @@ path: relative or absolute path
 cwd: directory that `path` is relative to; must be absolute
 
 """
-    path = os.path.expanduser(path)
-    return os.path.normpath(os.path.join(cwd, path))
+    # expanduser only does anything for paths starting with '~'
+    if path[:1] == '~':
+        path = os.path.expanduser(path)
+    if os.path.isabs(path):
+        return os.path.normpath(path)
+    else:
+        return os.path.normpath(os.path.join(cwd, path))
+
+
+def _get_abs_paths (paths, cwd):
+    """Make paths absolute.
+
+paths: iterable of paths, as taken by `_get_abs_path`
+cwd: as taken by `_get_abs_path`
+
+Returns an iterator over absolute paths.
+
+"""
+    expanduser = os.path.expanduser
+    isabs = os.path.isabs
+    normpath = os.path.normpath
+    join = os.path.join
+    for path in paths:
+        if path[:1] == '~':
+            path = expanduser(path)
+        yield normpath(path if isabs(path) else join(cwd, path))
+
+
+# `_all_parents` results by path; paths being renamed often share parents
+_parents_cache = {}
+# clear `_parents_cache` when it reaches this size, to bound memory use
+_MAX_PARENTS_CACHE = 4096
+
+
+def _all_parents (path):
+    # tuple of parents of a path, children first
+    result = _parents_cache.get(path)
+    if result is not None:
+        return result
+
+    # walk up until we reach root or a parent whose parents we already know
+    new_parents = []
+    current = path
+    while True:
+        parent = os.path.dirname(current)
+        if parent == current:
+            known = ()
+            break
+        new_parents.append(parent)
+        known = _parents_cache.get(parent)
+        if known is not None:
+            break
+        current = parent
+
+    result = tuple(new_parents) + known
+    if len(_parents_cache) >= _MAX_PARENTS_CACHE:
+        _parents_cache.clear()
+    _parents_cache[path] = result
+    if result:
+        # other paths in the same directory are likely to come next
+        _parents_cache[result[0]] = result[1:]
+    return result
 
 
 def parents (path, include_full=False, allow_empty=True):
@@ -49,21 +118,10 @@ allow_empty: the returned iterator may be empty; if `False` and `path` is root,
 Returns an iterator over parent paths.  The order is children before parents.
 
 """
-    found = False
-    if include_full:
+    all_parents = _all_parents(path)
+    if include_full or (not all_parents and not allow_empty):
         yield path
-        found = True
-
-    while True:
-        new_path = os.path.dirname(path)
-        if new_path == path:
-            if not found and not allow_empty:
-                yield path
-            break
-        else:
-            yield new_path
-            found = True
-            path = new_path
+    yield from all_parents
 
 
 class DestinationExistsError (OSError):
@@ -104,10 +162,62 @@ Returns a sequence of the paths that were created, deepest first.
     return create
 
 
+# maximum number of files copied at once when copying a directory
+_COPY_THREADS = 8
+
+
+def _copy_tree (frm, to):
+    """Copy a directory recursively.
+
+Like `shutil.copytree` with `symlinks=True`, but files are copied concurrently,
+since copying many small files is dominated by filesystem latency.  `to` must
+not exist.
+
+Raises OSError.
+
+"""
+    # `(source, destination)` for directories, parents first
+    dirs = []
+    files = []
+    todo = [(frm, to)]
+    while todo:
+        src_dir, dest_dir = todo.pop()
+        os.mkdir(dest_dir)
+        dirs.append((src_dir, dest_dir))
+        for entry in list(os.scandir(src_dir)):
+            dest = os.path.join(dest_dir, entry.name)
+            if entry.is_symlink():
+                os.symlink(os.readlink(entry.path), dest)
+                shutil.copystat(entry.path, dest, follow_symlinks=False)
+            elif entry.is_dir():
+                todo.append((entry.path, dest))
+            else:
+                files.append((entry.path, dest))
+
+    if len(files) > 1:
+        with ThreadPoolExecutor(max_workers=_COPY_THREADS) as executor:
+            copies = [executor.submit(shutil.copy2, src, dest)
+                      for src, dest in files]
+            # raises the first error, after all copies have finished
+            for copy in copies:
+                copy.result()
+    else:
+        for src, dest in files:
+            shutil.copy2(src, dest)
+
+    # children first, since copying contents changes modification times
+    for src, dest in reversed(dirs):
+        shutil.copystat(src, dest)
+
+
 def _copy_dir (frm, to, leave_frm=True):
     """Copy a directory recursively."""
     try:
-        shutil.copytree(frm, to, symlinks=True)
+        if hasattr(os, 'scandir'):
+            _copy_tree(frm, to)
+        else:
+            # no os.scandir until 3.5
+            shutil.copytree(frm, to, symlinks=True)
         if not leave_frm:
             shutil.rmtree(frm)
     except OSError:
@@ -154,6 +264,22 @@ def _rename (frm, to):
             raise
 
 
+# directories known to exist, since we created them or moved files into them
+# - they may have been moved or removed since, so renames relying on this are
+#   retried with the directory created if they fail with a missing path
+_known_dirs = set()
+# clear `_known_dirs` when it reaches this size, to bound memory use
+_MAX_KNOWN_DIRS = 4096
+
+
+def _remember_dir (path):
+    # add a directory and its parents to `_known_dirs`
+    if len(_known_dirs) >= _MAX_KNOWN_DIRS:
+        _known_dirs.clear()
+    _known_dirs.add(path)
+    _known_dirs.update(parents(path))
+
+
 def rename (frm, to, leave_frm=False):
     """Rename a file.
 
@@ -166,25 +292,43 @@ leave_frm: whether to leave `frm` as it is (copy)
 Raises OSError.
 
 """
-    if (os.path.normcase(frm) == os.path.normcase(to)):
-        pass
-    elif os.path.exists(to):
+    if comparable_path(frm) == comparable_path(to):
+        return
+
+    if os.path.exists(to):
         raise DestinationExistsError(to)
-    else:
-        created = _ensure_dir_exists(os.path.dirname(to))
+
+    def move ():
+        if leave_frm:
+            _copy(frm, to, True)
+        else:
+            _rename(frm, to)
+
+    to_dir = os.path.dirname(to)
+    # renames are often into the same directories as previous ones
+    known = to_dir in _known_dirs
+    created = () if known else _ensure_dir_exists(to_dir)
+    try:
         try:
-            if leave_frm:
-                _copy(frm, to, True)
-            else:
-                _rename(frm, to)
+            move()
+        except FileNotFoundError:
+            if not known:
+                raise
+            # the directory may have been moved since we saw it
+            _known_dirs.clear()
+            created = _ensure_dir_exists(to_dir)
+            move()
+    except OSError:
+        _known_dirs.discard(to_dir)
+        # remove created directories
+        try:
+            for path in created:
+                os.rmdir(path)
         except OSError:
-            # remove created directories
-            try:
-                for path in created:
-                    os.rmdir(path)
-            except OSError:
-                pass
-            raise
+            pass
+        raise
+    else:
+        _remember_dir(to_dir)
 
 
 def _get_renames (with_warnings, inps, fields, template, cwd=None,
@@ -195,8 +339,8 @@ with_warnings: whether to compute warnings that can only be determined while
                determining the source and destination paths.
 
 Returns `(renames, done)` like `get_renames`; `renames` yields
-`(input_path, output_path, warnings)`, where warnings is a sequence of util.Warn
-instances (empty if `with_warnings` is False).
+`(input_path, output_path, warnings)`, where warnings is a new list of util.Warn
+instances (or an empty sequence if `with_warnings` is False).
 
 """
     if cwd is None:
@@ -204,29 +348,38 @@ instances (empty if `with_warnings` is False).
     cwd = os.path.abspath(cwd)
 
     paths = itertools.chain.from_iterable(inps)
-    abs_paths = map(lambda path: _get_abs_path(path, cwd), paths)
+    abs_paths = _get_abs_paths(paths, cwd)
     result, state = fields.evaluate(abs_paths, interrupt)
 
     def get ():
+        # bind to locals, since these are used for every path
+        substitute = template.substitute
+        safe_substitute = template.safe_substitute
+        get_abs_path = _get_abs_path
+
+        if not with_warnings:
+            for path, field_vals in result:
+                yield (path, get_abs_path(safe_substitute(field_vals), cwd), ())
+            return
+
         for path, field_vals in result:
             warnings = []
             dest_path = None
 
-            if with_warnings:
-                try:
-                    dest_path = template.substitute(field_vals)
-                except ValueError:
-                    pass
-                except KeyError as e:
-                    # NOTE: warning detail for unknown fields; placeholders are
-                    # the source filename and the field names
-                    detail = _('{0}: fields: {1}').format(
-                        fmt_path(path), ', '.join(map(repr, e.args)))
-                    warnings.append(util.Warn('unresolved fields', detail))
+            try:
+                dest_path = substitute(field_vals)
+            except ValueError:
+                pass
+            except KeyError as e:
+                # NOTE: warning detail for unknown fields; placeholders are the
+                # source filename and the field names
+                detail = _('{0}: fields: {1}').format(
+                    fmt_path(path), ', '.join(map(repr, e.args)))
+                warnings.append(util.Warn('unresolved fields', detail))
 
             if dest_path is None:
-                dest_path = template.safe_substitute(field_vals)
-            yield (path, _get_abs_path(dest_path, cwd), warnings)
+                dest_path = safe_substitute(field_vals)
+            yield (path, get_abs_path(dest_path, cwd), warnings)
 
     return (get(), lambda: fields.cleanup(state))
 
@@ -251,9 +404,4 @@ done: function to call with no arguments to clean up some internal state when
 
 """
     renames, done = _get_renames(False, *args, **kwargs)
-
-    def get ():
-        for frm, to, warnings in renames:
-            yield (frm, to)
-
-    return (get(), done)
+    return (((frm, to) for frm, to, warnings in renames), done)
@@ -6,12 +6,31 @@ Foundation, either version 3 of the License, or (at your option) any later
 version."""
 
 import itertools
+import collections
+import functools
 import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
 
 from .. import util, conf
 from . import rename, db
 
 
+def _windows_path_invalid (path):
+    # `path_invalid` for Windows
+    if path.endswith(('.', ' ')):
+        return _('trailing spaces and dots will be removed from the filename')
+
+
+def _path_valid (path):
+    # `path_invalid` for platforms where we don't know of any problems
+    return None
+
+
+# the checks only depend on the platform, so choose them once
+_path_invalid = _windows_path_invalid if conf.WINDOWS else _path_valid
+
+
 def path_invalid (path):
     """Determine if a path is invalid.
 
@@ -20,31 +39,58 @@ Detects problems which will not cause an error to be raised when using the path.
 Returns a string with the reason for the path being invalid, or None.
 
 """
-    if conf.WINDOWS:
-        if path.endswith('.') or path.endswith(' '):
-            return _(
-                'trailing spaces and dots will be removed from the filename'
-            )
+    return _path_invalid(path)
 
 
-def safe_stat (path):
-    try:
+# support for `follow_symlinks` depends on the platform, so check it once
+if os.stat in os.supports_follow_symlinks:
+    def safe_stat (path):
         return os.stat(path, follow_symlinks=False)
-    except NotImplementedError:
-        return os.stat(path)
+else:
+    safe_stat = os.stat
 
 
-def safe_access (path, mode):
-    try:
+if os.access in os.supports_follow_symlinks:
+    def safe_access (path, mode):
         return os.access(path, mode, follow_symlinks=False)
-    except NotImplementedError:
-        return os.access(path, mode)
+else:
+    safe_access = os.access
+
+
+def _safe_stat_or_none (path):
+    # like `safe_stat`, but returns `None` if the path can't be stat'ed
+    try:
+        return safe_stat(path)
+    except (OSError, ValueError):
+        return None
 
 
-def path_device (path):
-    """Determine the device containing the given path."""
+def _exists (path, st):
+    # `os.path.exists`, given `_safe_stat_or_none(path)`
+    if st is None:
+        return False
+    # os.path.exists follows symlinks
+    return not stat.S_ISLNK(st.st_mode) or os.path.exists(path)
+
+
+def path_device (path, st=None, devices=None):
+    """Determine the device containing the given path.
+
+st: result of `safe_stat(path)`, if already known
+devices: `dict` to cache results in, for paths we had to look at while finding
+         the device; only valid while the filesystem doesn't change
+
+"""
+    if st is not None:
+        return st.st_dev
     dev = None
+    # paths whose result is `dev`
+    checked = []
     for parent in rename.parents(path, True):
+        if devices is not None and parent in devices:
+            dev = devices[parent]
+            break
+        checked.append(parent)
         try:
             dev = safe_stat(parent).st_dev
         except (FileNotFoundError, NotADirectoryError):
@@ -53,35 +99,50 @@ def path_device (path):
             break
         else:
             break
+
+    if devices is not None:
+        for parent in checked:
+            devices[parent] = dev
     return dev
 
 
+def _nearest_parent_stat (path, cache=None):
+    # like `path_nearest_parent`, but returns `(parent, st)`, where `st` is the
+    # result of `os.stat(parent)`, or `None` if no parent exists
+    # - cache: `dict` to cache results in; the result only depends on the
+    #   directory containing `path`, which many paths share
+    if cache is not None:
+        path_dir = os.path.dirname(path)
+        result = cache.get(path_dir)
+        if result is None:
+            result = cache[path_dir] = _nearest_parent_stat(path)
+        return result
+
+    for parent in rename.parents(path, allow_empty=False):
+        try:
+            return (parent, os.stat(parent))
+        except (OSError, ValueError):
+            pass
+    # in case root doesn't exist for some reason, use the last parent we found
+    return (parent, None)
+
+
 def path_nearest_parent (path):
     """Get the nearest existing parent of the given path."""
-    nearest_parent = None
-    for parent in rename.parents(path, allow_empty=False):
-        if os.path.exists(parent):
-            nearest_parent = parent
-            break
-    # in case os.path.exists gives False for root for some reason, use the last
-    # parent we found
-    return parent if nearest_parent is None else nearest_parent
+    return _nearest_parent_stat(path)[0]
 
 
-def _find_check (query, mk_warning):
-    """Run a `db` query to get a warning as a single rename.
+def _find_check (found, mk_warning):
+    """Create a warning from a rename found by a `db` query.
 
-query: function to call which returns a `(frm, to)` rename to use in creating a
-       warning
-mk_warning: function to call with the rename from `query` if not None; should
-            return a `util.Warn` instance
+found: `(frm, to)` rename returned by the query, or None
+mk_warning: function to call with `found` if not None; should return a
+            `util.Warn` instance
 
-Returns an iterator of `util.Warn` instances from `mk_warning`
+Returns the `util.Warn` instance from `mk_warning`, or None.
 
 """
-    rename = query()
-    if rename is not None:
-        yield mk_warning(rename)
+    return None if found is None else mk_warning(found)
 
 
 def _same_warning (cat, existing_rename, new_rename):
@@ -92,10 +153,12 @@ existing_rename: `(frm, to)` for the matching rename
 new_rename: `(frm, to)` for rename being checked
 
 """
-    detail = '{}, {}'.format(
-        rename.preview_rename(*existing_rename),
-        rename.preview_rename(*new_rename)
-    )
+    def detail ():
+        return '{}, {}'.format(
+            rename.preview_rename(*existing_rename),
+            rename.preview_rename(*new_rename)
+        )
+
     return util.Warn(cat, detail)
 
 
@@ -106,8 +169,10 @@ existing_rename: `(frm, to)` for the clashing rename
 new_frm: source path for rename being checked
 
 """
-    detail = '{}, {}'.format(rename.fmt_path(existing_rename[0]),
-                             rename.fmt_path(new_frm))
+    def detail ():
+        return '{}, {}'.format(rename.fmt_path(existing_rename[0]),
+                               rename.fmt_path(new_frm))
+
     return util.Warn('source parent', detail)
 
 
@@ -126,34 +191,90 @@ Should only be called once for each rename.
     cmp_frm = rename.comparable_path(frm)
     cmp_to = rename.comparable_path(to)
     warnings = []
+    # one query for all checks
+    same_frm, same_to, frm_child, frm_parent = wdb.find_all(cmp_frm, cmp_to)
 
     # check for duplicates
-    same_frm_warnings = tuple(_find_check(
-        lambda: wdb.find_frm(cmp_frm),
-        lambda rename: _same_warning('dup source', rename, (frm, to))
-    ))
-    warnings.extend(same_frm_warnings)
-    warnings.extend(_find_check(
-        lambda: wdb.find_to(cmp_to),
-        lambda rename: _same_warning('dup dest', rename, (frm, to))
-    ))
-
-    # if not a duplicate, check for children
-    if not same_frm_warnings:
-        frm_child_warnings = tuple(_find_check(
-            lambda: wdb.find_frm_child(cmp_frm),
-            lambda rename: _frm_parent_warning(rename, frm)
-        ))
-        warnings.extend(frm_child_warnings)
-
-        # if not a parent, check for parents
-        if not frm_child_warnings:
-            warnings.extend(_find_check(
-                lambda: wdb.find_frm_parent(cmp_frm),
-                lambda rename: _frm_parent_warning(rename, frm)
-            ))
-
-    wdb.add(frm, to)
+    same_frm_warning = _find_check(
+        same_frm,
+        lambda rename: _same_warning('dup source', rename, (frm, to)))
+    if same_frm_warning is not None:
+        warnings.append(same_frm_warning)
+    same_to_warning = _find_check(
+        same_to,
+        lambda rename: _same_warning('dup dest', rename, (frm, to)))
+    if same_to_warning is not None:
+        warnings.append(same_to_warning)
+
+    # if not a duplicate, check for children, and if not a parent, check for
+    # parents
+    if same_frm_warning is None:
+        frm_parent_warning = _find_check(
+            frm_child if frm_child is not None else frm_parent,
+            lambda rename: _frm_parent_warning(rename, frm))
+        if frm_parent_warning is not None:
+            warnings.append(frm_parent_warning)
+
+    wdb.add(frm, to, cmp_frm, cmp_to)
+    return warnings
+
+
+# number of threads used to check renames against the filesystem
+_CHECK_THREADS = 8
+# maximum number of renames being checked against the filesystem at once
+_MAX_PENDING_CHECKS = 64
+
+
+def _get_independent_warnings (frm, to, devices, nearest_parents):
+    """Get warnings for a new rename that don't depend on other renames.
+
+frm: source path for new rename
+to: destination path for new rename
+devices: as taken by `path_device`
+nearest_parents: `dict` to cache nearest existing parents of missing
+                 destinations in
+
+Returns sequence of util.Warn instances.
+
+Only looks at the filesystem, so may be called from any thread.
+
+"""
+    warnings = []
+    # stat once for all checks
+    frm_stat = _safe_stat_or_none(frm)
+    to_stat = _safe_stat_or_none(to)
+
+    if not _exists(frm, frm_stat):
+        warnings.append(util.Warn('source', rename.fmt_path(frm)))
+    elif not safe_access(frm, os.R_OK):
+        warnings.append(util.Warn('source perm', rename.fmt_path(frm)))
+
+    detail = _path_invalid(to)
+    if detail is not None:
+        warnings.append(util.Warn(
+            # NOTE: warning detail for an invalid destination path;
+            # placeholders are the path and the problem with it
+            'dest', '{0}: {1}'.format(rename.fmt_path(to), detail)))
+
+    if _exists(to, to_stat):
+        warnings.append(util.Warn(
+            'dest exists', functools.partial(rename.preview_rename, frm, to)))
+    else:
+        # stat once for existence and type
+        to_nearest_parent, parent_stat = _nearest_parent_stat(
+            to, nearest_parents)
+        if (
+            # can't write to subdirs of files
+            parent_stat is None or not stat.S_ISDIR(parent_stat.st_mode) or
+            not safe_access(to_nearest_parent, os.W_OK)
+        ):
+            warnings.append(util.Warn('dest perm', rename.fmt_path(to)))
+
+    if (path_device(frm, frm_stat, devices) !=
+        path_device(to, to_stat, devices)):
+        warnings.append(util.Warn(
+            'cross device', functools.partial(rename.preview_rename, frm, to)))
+
     return warnings
 
 
@@ -171,6 +292,9 @@ Other arguments are as taken by `get_renames_with_warnings`.
 
     def get ():
         warnings = []
+        # renames are often within a few directories
+        devices = {}
+        nearest_parents = {}
 
         try:
             template.substitute()
@@ -179,43 +303,57 @@ Other arguments are as taken by `get_renames_with_warnings`.
         except KeyError:
             pass
 
-        for frm, to, new_warnings in renames:
-            warnings.extend(new_warnings)
-
-            if not os.path.exists(frm):
-                warnings.append(util.Warn('source', rename.fmt_path(frm)))
-            elif not safe_access(frm, os.R_OK):
-                warnings.append(util.Warn('source perm', rename.fmt_path(frm)))
-
-            detail = path_invalid(to)
-            if detail is not None:
-                warnings.append(util.Warn(
-                    # NOTE: warning detail for an invalid destination path;
-                    # placeholders are the path and the problem with it
-                    'dest', '{0}: {1}'.format(rename.fmt_path(to), detail)))
-
-            if os.path.exists(to):
-                warnings.append(
-                    util.Warn('dest exists', rename.preview_rename(frm, to)))
-            else:
-                to_nearest_parent = path_nearest_parent(to)
-                if (
-                    # can't write to subdirs of files
-                    not os.path.isdir(to_nearest_parent) or
-                    not safe_access(to_nearest_parent, os.W_OK)
-                ):
-                    warnings.append(util.Warn('dest perm', rename.fmt_path(to)))
-
-            if path_device(frm) != path_device(to):
-                warnings.append(
-                    util.Warn('cross device', rename.preview_rename(frm, to)))
-
-            warnings.extend(_get_dependent_warnings(wdb, frm, to))
-
-            yield ((frm, to), warnings)
-            warnings = []
-
-    return (get(), done)
+        # filesystem checks are mostly waiting on the OS, so run them for
+        # several renames at once; `wdb` is only used from this thread
+        # - `(frm, to, warnings, future)`, in the order renames were given
+        pending = collections.deque()
+        # bind to locals, since these are used for every path
+        pending_add = pending.append
+        pending_next = pending.popleft
+        get_dependent_warnings = _get_dependent_warnings
+        check = _get_independent_warnings
+
+        def finish ():
+            frm, to, warnings, checked = pending_next()
+            warnings.extend(checked.result())
+            warnings.extend(get_dependent_warnings(wdb, frm, to))
+            return ((frm, to), warnings)
+
+        executor = ThreadPoolExecutor(max_workers=_CHECK_THREADS)
+        submit = executor.submit
+        try:
+            for frm, to, new_warnings in renames:
+                if warnings:
+                    # template warnings go with the first rename
+                    warnings.extend(new_warnings)
+                    new_warnings, warnings = warnings, None
+                # `new_warnings` is a new list for each rename, so we can add
+                # to it rather than making another
+                pending_add((frm, to, new_warnings,
+                             submit(check, frm, to, devices,
+                                    nearest_parents)))
+                # yield whatever is ready, so results aren't held back until
+                # the queue is full
+                while pending and (len(pending) >= _MAX_PENDING_CHECKS or
+                                   pending[0][3].done()):
+                    yield finish()
+
+            while pending:
+                yield finish()
+        finally:
+            # if stopped early, don't wait for checks whose results are unused
+            for frm, to, rename_warnings, checked in pending:
+                checked.cancel()
+            executor.shutdown(wait=False)
+
+    renames_with_warnings = get()
+
+    def done_all ():
+        # stop checking renames before cleaning up
+        renames_with_warnings.close()
+        done()
+
+    return (renames_with_warnings, done_all)
 
 
 def get_renames_with_warnings (*args, **kwargs):
@@ -48,6 +48,8 @@ LOG = {
 CONF_FILENAME = 'settings'
 # minumum interval between Qt signals for potentially rapid emitters
 MIN_SIGNAL_INTERVAL = 0.2
+# minimum interval between saves of settings to disk
+MIN_SAVE_INTERVAL = 0.5
 # maximum number of renames shown in the preview
 MAX_PREVIEW_LENGTH = 500
 # maximum number of warning details to show for each category
@@ -102,13 +102,27 @@ class Warn:
     """A warning generated from the rename configuration.
 
 category: string from `WARNING_CAT` keys
-detail: string giving more information
+detail: string giving more information, or a function taking no arguments and
+        returning this string, to delay building it until it's needed
+
+Attributes:
+
+category: as passed to the constructor
+detail: the detail string
 
 """
 
     def __init__ (self, category, detail):
         self.category = category
-        self.detail = detail
+        self._detail = detail
+
+    @property
+    def detail (self):
+        detail = self._detail
+        if not isinstance(detail, str):
+            # most warnings aren't displayed, so build the string on demand
+            detail = self._detail = detail()
+        return detail
 
     @staticmethod
     def from_exc (category, exception):